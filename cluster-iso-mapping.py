@@ -16,27 +16,32 @@ Summary:
 import json
 import subprocess
 import sys
-import requests
 from getpass import getpass
 import logging
-import urllib3
 import os
-import re
+from pwd import getpwnam
+from grp import getgrnam
+import stat
 import argparse
 import time
+from concurrent.futures import ThreadPoolExecutor
 
-# Disable warnings
-urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
+# Optional streaming JSON parser for large host inventories
+try:
+    import ijson
+except ImportError:
+    ijson = None
 
-# Logging setup
+# Optional faster JSON encoder/decoder
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# Logging setup (file handler is attached in main via setup_logging)
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.DEBUG)
-formatter = logging.Formatter('%(asctime)s %(levelname)s %(message)s')
-from logging.handlers import RotatingFileHandler
 log_path = os.path.abspath('skip_hosts.log')
-file_handler = RotatingFileHandler(log_path, maxBytes=1_000_000, backupCount=3)
-file_handler.setFormatter(formatter)
-logger.addHandler(file_handler)
 
 # Constants
 CUSTOM_ISO_SPEC_FILENAME = 'generated_custom_iso_spec.json'
@@ -45,33 +50,46 @@ LCM_PROPERTIES_FILE = '/opt/vmware/vcf/lcm/lcm-app/conf/application-prod.propert
 LOCAL_PATH = 'https://localhost'
 SKIP_HOST_PROPERTY = 'esx.upgrade.skip.host.ids='
 CUSTOM_IMAGE_PROPERTY = 'lcm.esx.upgrade.custom.image.spec='
+LCM_ACTIVE_TIMEOUT = 60
+
+# Shared HTTP session (keep-alive, one TLS handshake for all API calls), created by init_session
+SESSION = None
 
 # Globals
 all_hosts_map = {}
-cluster_hosts_map = {}
 cluster_id_name = {}
+cluster_vendor_hosts = {}
 domain_hosts_map = {}
 domain_name_cluster_id_map = {}
 domain_name_id = {}
 global_vendor_iso_map = {}
+valid_iso_paths = set()
+bundle_version_map = {}
 esx_custom_image_spec_list = []
-hosts_to_skip = []
+hosts_to_skip = set()
 one_custom_iso_per_vendor = False
 global_bundle_id = None
 global_target_esx_version = None
 
 # Data classes
 class EsxCustomImageSpecObj:
+    __slots__ = ('bundleId', 'targetEsxVersion', 'useVcfBundle', 'domainId', 'clusterId', 'customIsoAbsolutePath')
+
     def __init__(self, bundle_id, target_esxi_version, domain_id, custom_iso_absolute_path, cluster_id=None):
         self.bundleId = bundle_id
         self.targetEsxVersion = target_esxi_version
         self.useVcfBundle = False
         self.domainId = domain_id
-        if cluster_id:
-            self.clusterId = cluster_id
+        self.clusterId = cluster_id
         self.customIsoAbsolutePath = custom_iso_absolute_path
 
+    def to_dict(self):
+        """Spec entry as written to JSON; clusterId is omitted when not set."""
+        return {k: getattr(self, k) for k in self.__slots__ if k != 'clusterId' or self.clusterId}
+
 class Host:
+    __slots__ = ('id', 'fqdn', 'domain_id', 'cluster_id', 'vendor')
+
     def __init__(self, id, fqdn, domain_id, cluster_id, vendor):
         self.id = id
         self.fqdn = fqdn
@@ -80,36 +98,77 @@ class Host:
         self.vendor = vendor
 
 # Utility functions
+def setup_logging():
+    from logging.handlers import RotatingFileHandler
+    file_handler = RotatingFileHandler(log_path, maxBytes=1_000_000, backupCount=3)
+    file_handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)s %(message)s'))
+    logger.addHandler(file_handler)
+
+def init_session():
+    """Import the HTTP stack and create the shared session; deferred so --help and early exits stay fast."""
+    global SESSION
+    import requests
+    import urllib3
+    from requests.adapters import HTTPAdapter
+    urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
+    SESSION = requests.Session()
+    SESSION.mount('https://', HTTPAdapter(pool_connections=8, pool_maxsize=16))
+    SESSION.verify = False
+    SESSION.headers.update({'Content-Type':'application/json'})
+
+def load_json(resp):
+    """Decode an API response body, using orjson when it is installed."""
+    if orjson is not None:
+        return orjson.loads(resp.content)
+    return resp.json()
+
+def dump_json(obj, pretty=False):
+    """Encode obj to UTF-8 JSON bytes; compact output uses orjson when it is installed."""
+    if pretty:
+        # orjson only supports 2-space indent; keep the documented 4-space layout
+        return json.dumps(obj, indent=4).encode()
+    if orjson is not None:
+        return orjson.dumps(obj)
+    return json.dumps(obj, separators=(',', ':')).encode()
+
 def check_if_directory_exists(dirname):
     return os.path.isdir(dirname)
 
 def check_if_iso_exists(iso):
-    return os.path.isfile(iso) and iso.lower().endswith('.iso')
+    """Stat each ISO path once; only valid paths are cached so a corrected path is re-checked on retry."""
+    if iso in valid_iso_paths:
+        return True
+    if not iso.lower().endswith('.iso'):
+        return False
+    try:
+        if not stat.S_ISREG(os.stat(iso).st_mode):
+            return False
+    except OSError:
+        return False
+    valid_iso_paths.add(iso)
+    return True
 
 def check_if_valid_sso(user, pwd):
     try:
-        data = json.dumps({'username': user, 'password': pwd})
-        resp = requests.post(f"{LOCAL_PATH}/v1/tokens",
-                             headers={'Content-Type':'application/json'},
-                             data=data, verify=False)
+        data = dump_json({'username': user, 'password': pwd})
+        resp = SESSION.post(f"{LOCAL_PATH}/v1/tokens", data=data)
         return resp.status_code == 200
     except Exception:
         return False
 
-def get_auth_headers(user, pwd):
-    data = json.dumps({'username': user, 'password': pwd})
-    resp = requests.post(f"{LOCAL_PATH}/v1/tokens",
-                         headers={'Content-Type':'application/json'},
-                         data=data, verify=False)
-    token = resp.json().get('accessToken')
-    return {'Content-Type':'application/json', 'Authorization':f'Bearer {token}'}
+def authenticate_session(user, pwd):
+    """Request an API token and attach it to the shared session."""
+    data = dump_json({'username': user, 'password': pwd})
+    resp = SESSION.post(f"{LOCAL_PATH}/v1/tokens", data=data)
+    token = load_json(resp).get('accessToken')
+    SESSION.headers['Authorization'] = f'Bearer {token}'
 
 def execute_cmd_locally(cmd, log_stdout=True):
-    logger.debug(f"RUN: {cmd}")
-    ps = subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    out, err = ps.communicate()
-    out_s = out.decode() if out else ""
-    err_s = err.decode() if err else ""
+    """Run cmd (an argument list, no shell) and return (returncode, stdout, stderr)."""
+    logger.debug(f"RUN: {' '.join(cmd)}")
+    ps = subprocess.run(cmd, capture_output=True, text=True, check=False)
+    out_s = ps.stdout or ""
+    err_s = ps.stderr or ""
     if log_stdout and out_s.strip():
         logger.debug(out_s.strip())
     if err_s.strip():
@@ -117,43 +176,87 @@ def execute_cmd_locally(cmd, log_stdout=True):
     logger.debug(f"EXIT {ps.returncode}")
     return ps.returncode, out_s, err_s
 
+def chown_recursive(path, user, group):
+    """Equivalent of chown -R user:group path (symlinks themselves, not their targets) without a shell."""
+    try:
+        uid = getpwnam(user).pw_uid
+        gid = getgrnam(group).gr_gid
+    except KeyError as exc:
+        logger.error(f"Error resolving owner {user}:{group}: {exc}")
+        return
+    paths = [path]
+    for root, dirs, files in os.walk(path):
+        paths.extend(os.path.join(root, name) for name in dirs + files)
+    for p in paths:
+        try:
+            os.chown(p, uid, gid, follow_symlinks=False)
+        except OSError as exc:
+            logger.error(f"Error changing owner of {p}: {exc}")
+
+def wait_for_lcm_api(timeout=LCM_ACTIVE_TIMEOUT, interval=1):
+    """Poll the LCM-served bundles endpoint until it answers 200 or timeout seconds pass."""
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            resp = SESSION.get(f"{LOCAL_PATH}/v1/bundles?productType=ESX", timeout=5)
+            if resp.status_code == 200:
+                return True
+        except Exception:
+            pass
+        time.sleep(interval)
+    return False
+
 # Inventory fetch
-def get_all_domain_names_in_env(headers):
-    resp = requests.get(f"{LOCAL_PATH}/v1/domains", headers=headers, verify=False)
-    for d in resp.json().get('elements', []):
+def get_all_domain_names_in_env():
+    resp = SESSION.get(f"{LOCAL_PATH}/v1/domains")
+    for d in load_json(resp).get('elements', []):
         name = d['name']
         did = d['id']
         domain_name_id[name] = did
         domain_name_cluster_id_map[name] = [c['id'] for c in d.get('clusters', [])]
 
 
-def get_all_clusters(headers):
-    resp = requests.get(f"{LOCAL_PATH}/v1/clusters", headers=headers, verify=False)
-    for c in resp.json().get('elements', []):
+def get_all_clusters():
+    resp = SESSION.get(f"{LOCAL_PATH}/v1/clusters")
+    for c in load_json(resp).get('elements', []):
         cluster_id_name[c['id']] = c['name']
 
 
-def get_all_hosts(headers):
-    resp = requests.get(f"{LOCAL_PATH}/v1/hosts", headers=headers, verify=False)
-    for h in resp.json().get('elements', []):
+def iter_host_elements():
+    """Yield host elements from /v1/hosts, streamed with ijson when it is installed."""
+    with SESSION.get(f"{LOCAL_PATH}/v1/hosts", stream=ijson is not None) as resp:
+        if ijson is None:
+            yield from load_json(resp).get('elements', [])
+            return
+        resp.raw.decode_content = True
+        yield from ijson.items(resp.raw, 'elements.item')
+
+def get_all_hosts():
+    for h in iter_host_elements():
         if h.get('status') == 'ASSIGNED':
             host = Host(h['id'], h['fqdn'], h['domain']['id'], h['cluster']['id'], h['hardwareVendor'])
             all_hosts_map[host.id] = host
-            cluster_hosts_map.setdefault(host.cluster_id, []).append(host.id)
+            cluster_vendor_hosts.setdefault(host.cluster_id, {}).setdefault(host.vendor, []).append(host.id)
             domain_hosts_map.setdefault(host.domain_id, []).append(host.id)
 
-def get_esx_bundle_upgrade_to_version(bundle_id, headers):
-    resp = requests.get(f"{LOCAL_PATH}/v1/bundles/{bundle_id}", headers=headers, verify=False)
-    comp = resp.json().get('components', [{}])[0]
+def get_esx_bundle_upgrade_to_version(bundle_id):
+    resp = SESSION.get(f"{LOCAL_PATH}/v1/bundles/{bundle_id}")
+    comp = load_json(resp).get('components', [{}])[0]
     return comp.get('toVersion', '')
 
+def list_esx_bundles():
+    resp = SESSION.get(f"{LOCAL_PATH}/v1/bundles?productType=ESX")
+    for b in load_json(resp).get('elements', []):
+        bundle_version_map[b['id']] = b.get('components',[{}])[0].get('toVersion','')
+    return list(bundle_version_map.items())
+
 def skiphostsfromclusterofvendor(vendors, cluster_id):
-    for hid in cluster_hosts_map.get(cluster_id, []):
-        if all_hosts_map[hid].vendor in vendors:
-            hosts_to_skip.append(hid)
+    vendor_hosts = cluster_vendor_hosts.get(cluster_id, {})
+    for v in vendors:
+        hosts_to_skip.update(vendor_hosts.get(v, ()))
 
 def get_hosts_to_skip():
-    return ','.join(sorted(set(hosts_to_skip)))
+    return ','.join(sorted(hosts_to_skip))
 
 def return_custom_iso_path(vendor, cluster_name=None):
     # Single ISO per vendor: cluster context not shown
@@ -179,40 +282,52 @@ def input_iso_path(vendor, cluster_name=None):
     sys.exit("Valid ISO path required")
 
 # Property updates
-def update_esx_upgrade_custom_upgrade_spec(outpath):
-    """Set lcm.esx.upgrade.custom.image.spec to the provided JSON path in the LCM properties file."""
+def set_property_lines(lines, updates):
+    """Rewrite lines starting with a property in updates in a single pass, appending any that are absent."""
+    pending = dict(updates)
+    for i, cur in enumerate(lines):
+        for prop, value in updates.items():
+            if cur.startswith(prop):
+                lines[i] = prop + value + cur[len(cur.rstrip('\r\n')):]
+                pending.pop(prop, None)
+                break
+    if pending:
+        if lines and not lines[-1].endswith('\n'):
+            lines[-1] += '\n'
+        lines.extend(prop + value + '\n' for prop, value in pending.items())
+    return lines
+
+def write_properties_file(text):
+    """Atomically replace the LCM properties file, keeping its mode and ownership."""
+    st = os.stat(LCM_PROPERTIES_FILE)
+    tmp = LCM_PROPERTIES_FILE + '.tmp'
+    # Create the temp file with the original mode (the file holds credentials) and never follow a stale link
+    fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC | os.O_NOFOLLOW, st.st_mode & 0o7777)
     try:
-        with open(LCM_PROPERTIES_FILE, 'r+') as f:
-            text = f.read()
-            line = CUSTOM_IMAGE_PROPERTY + outpath
-            if re.search(r'^lcm\.esx\.upgrade\.custom\.image\.spec=', text, flags=re.MULTILINE):
-                text = re.sub(r'^lcm\.esx\.upgrade\.custom\.image\.spec=.*$', line, text, flags=re.MULTILINE)
-            else:
-                text += '' + line
-            f.seek(0)
+        with os.fdopen(fd, 'w') as f:
+            os.fchmod(f.fileno(), st.st_mode & 0o7777)
+            os.fchown(f.fileno(), st.st_uid, st.st_gid)
             f.write(text)
-            f.truncate()
-        logger.info("Updated custom image spec property")
-    except Exception as exc:
-        logger.error(f"Error updating custom image spec property: {exc}")
-
-def update_esx_upgrades_skip_hosts_property():
-    """Set esx.upgrade.skip.host.ids with a comma-separated list of host IDs to skip."""
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, LCM_PROPERTIES_FILE)
+    except BaseException:
+        try:
+            os.unlink(tmp)
+        except OSError:
+            pass
+        raise
+
+def update_lcm_properties(updates):
+    """Apply {property: value} updates to the LCM properties file with one read and one atomic write."""
     try:
-        line = SKIP_HOST_PROPERTY + get_hosts_to_skip()
-        with open(LCM_PROPERTIES_FILE, 'r+') as f:
-            text = f.read()
-            if re.search(r'^esx\.upgrade\.skip\.host\.ids=', text, flags=re.MULTILINE):
-                text = re.sub(r'^esx\.upgrade\.skip\.host\.ids=.*$', line, text, flags=re.MULTILINE)
-            else:
-                text += '' + line
-            f.seek(0)
-            f.write(text)
-            f.truncate()
-        logger.info("Updated skip hosts property")
-        logger.info(f"Skip hosts count: {len(set(hosts_to_skip))}")
+        with open(LCM_PROPERTIES_FILE) as f:
+            lines = f.read().splitlines(keepends=True)
+        set_property_lines(lines, updates)
+        write_properties_file(''.join(lines))
+        logger.info(f"Updated LCM properties: {', '.join(p.rstrip('=') for p in updates)}")
     except Exception as exc:
-        logger.error(f"Error updating skip hosts property: {exc}")
+        logger.error(f"Error updating LCM properties: {exc}")
 
 # Argument parsing
 def parse_args():
@@ -232,18 +347,20 @@ def main():
     args = parse_args()
     if os.geteuid() != 0:
         sys.exit("Root privileges required")
+    setup_logging()
     print("NOTE: Previous changes may be overwritten \n")
     if input("Are you sure you want to run this script? (y/n): ").strip().lower() not in ('y','yes'):
         sys.exit("Exiting.")
     print(f"Log file: {log_path}\n")
     logger.info("=== Script start ===")
+    init_session()
 
     # SSO prompt
     for i in range(3):
         user = input("Enter SSO User: ").strip()
         pwd = getpass("Enter SSO Password: ")
         if check_if_valid_sso(user, pwd):
-            headers = get_auth_headers(user, pwd)
+            authenticate_session(user, pwd)
             break
         print(f"Invalid SSO credentials")
     else:
@@ -258,20 +375,18 @@ def main():
         else:
             sys.exit("Invalid directory")
 
-    # Fetch inventory
-    get_all_domain_names_in_env(headers)
-    domains = list(domain_name_cluster_id_map.keys())
-    get_all_clusters(headers)
-    get_all_hosts(headers)
+    # Fetch inventory (independent read-only calls, each fills its own globals)
+    with ThreadPoolExecutor(max_workers=4) as pool:
+        inventory = [pool.submit(get_all_domain_names_in_env),
+                     pool.submit(get_all_clusters),
+                     pool.submit(get_all_hosts)]
+        bundles_future = pool.submit(list_esx_bundles)
+        for f in inventory:
+            f.result()
+        bundles = bundles_future.result()
     logger.info(f"Inventory loaded: domains={len(domain_name_id)}, clusters={len(cluster_id_name)}, hosts={len(all_hosts_map)}")
 
     # ESX bundle selection via LCM API
-    def list_esx_bundles(headers):
-        resp = requests.get(f"{LOCAL_PATH}/v1/bundles?productType=ESX", headers=headers, verify=False)
-        bundles = resp.json().get('elements', [])
-        return [ (b['id'], b.get('components',[{}])[0].get('toVersion','')) for b in bundles ]
-
-    bundles = list_esx_bundles(headers)
     if not bundles:
         sys.exit("No ESX bundles found via LCM API.")
     print("\nAvailable ESX bundles:")
@@ -339,6 +454,10 @@ def main():
             for cid, _, d in options:
                 selected.setdefault(d, []).append(cid)
         else:
+            by_id = {cid: (cid, name, d) for cid, name, d in options}
+            by_name = {}
+            for opt in options:
+                by_name.setdefault(opt[1], opt)
             for ent in raw.split(','):
                 key = ent.strip()
                 if not key:
@@ -351,7 +470,7 @@ def main():
                         print(f"  Skipping invalid index: {key}")
                         continue
                 else:
-                    match = next(((c, n, d0) for c, n, d0 in options if key == c or key == n), None)
+                    match = by_id.get(key) or by_name.get(key)
                     if not match:
                         print(f"  Skipping unknown cluster: {key}")
                         continue
@@ -366,7 +485,7 @@ def main():
     for d, clist in selected.items():
         for cid in clist:
             cname = cluster_id_name.get(cid, cid)
-            vendors = {all_hosts_map[h].vendor for h in cluster_hosts_map.get(cid, [])}
+            vendors = set(cluster_vendor_hosts.get(cid, {}))
             if len(vendors) == 1:
                 up = vendors.pop()
             else:
@@ -381,36 +500,43 @@ def main():
 
             iso_path = return_custom_iso_path(up, cname)
             bid = bundle_id if bundle_id else input(f"Enter bundle ID for cluster {cname}: ")
-            tv = target_version if target_version else get_esx_bundle_upgrade_to_version(bid, headers)
+            tv = target_version or bundle_version_map.get(bid)
+            if not tv:
+                tv = bundle_version_map[bid] = get_esx_bundle_upgrade_to_version(bid)
 
             esx_custom_image_spec_list.append(
                 EsxCustomImageSpecObj(bid, tv, domain_name_id[d], iso_path, cid)
             )
 
     # Write JSON spec
-    spec = {'esxCustomImageSpecList': [o.__dict__ for o in esx_custom_image_spec_list]}
+    spec = {'esxCustomImageSpecList': [o.to_dict() for o in esx_custom_image_spec_list]}
     outpath = os.path.join(spec_path, CUSTOM_ISO_SPEC_FILENAME)
-    with open(outpath, 'w') as f:
-        json.dump(spec, f, indent=4)
+    with open(outpath, 'wb') as f:
+        f.write(dump_json(spec, pretty=os.environ.get('VCF_SPEC_PRETTY', '').strip().lower() in ('1', 'true', 'yes')))
     logger.info(f"Wrote custom ISO spec: {outpath} entries={len(esx_custom_image_spec_list)}")
-    execute_cmd_locally(f"chmod 755 {outpath}")
-    execute_cmd_locally(f"chown -R vcf_lcm:vcf {spec_path}")
+    try:
+        os.chmod(outpath, 0o755)
+    except OSError as exc:
+        logger.error(f"Error setting permissions on {outpath}: {exc}")
+    chown_recursive(spec_path, 'vcf_lcm', 'vcf')
 
     # Update LCM properties
-    update_esx_upgrade_custom_upgrade_spec(outpath)
+    updates = {CUSTOM_IMAGE_PROPERTY: outpath}
+    if hosts_to_skip:
+        updates[SKIP_HOST_PROPERTY] = get_hosts_to_skip()
+        logger.info(f"Skip hosts count: {len(hosts_to_skip)}")
+    update_lcm_properties(updates)
     print(f"\nSuccessfully updated {LCM_PROPERTIES_FILE} with custom ISO spec location\n")
     if hosts_to_skip:
-        update_esx_upgrades_skip_hosts_property()
         print(f"Successfully updated skip hosts in LCM properties file located at {LCM_PROPERTIES_FILE}\n")
         print("Hosts that will be skipped are:\n")
         # Reverse map domain IDs to names
         domain_id_name = {v: k for k, v in domain_name_id.items()}
-        for hid in hosts_to_skip:
-            host = all_hosts_map.get(hid)
-            if host:
-                dom_name = domain_id_name.get(host.domain_id, host.domain_id)
-                clust_name = cluster_id_name.get(host.cluster_id, host.cluster_id)
-                print(f"- {host.fqdn} ({host.vendor}) in domain {dom_name}, cluster {clust_name}")
+        skipped = (all_hosts_map.get(hid) for hid in sorted(hosts_to_skip))
+        lines = [f"- {h.fqdn} ({h.vendor}) in domain {domain_id_name.get(h.domain_id, h.domain_id)}, "
+                 f"cluster {cluster_id_name.get(h.cluster_id, h.cluster_id)}"
+                 for h in skipped if h]
+        sys.stdout.write('\n'.join(lines) + '\n')
 
     # Summary
     summary = ', '.join([f"{cnt} {vendor} clusters" for vendor, cnt in vendor_count.items()])
@@ -419,12 +545,19 @@ def main():
 
     # Restart prompt
     if input("Restart LCM service now? (y/n): ").strip().lower() in ('y','yes'):
-        execute_cmd_locally('systemctl restart lcm')
         print('Restarting LCM service... \n')
-        print('Waiting for service to start...\n')
-        time.sleep(20)
-        logger.info("LCM restarted")
-        print("LCM service restarted")
+        rc, _, err = execute_cmd_locally(['systemctl', 'restart', 'lcm'])
+        if rc != 0:
+            logger.error(f"LCM restart failed with exit code {rc}")
+            print(f"ERROR: LCM service restart failed (exit code {rc}): {err.strip()}")
+        else:
+            print('Waiting for LCM API to respond...\n')
+            if wait_for_lcm_api():
+                logger.info("LCM restarted")
+                print("LCM service restarted")
+            else:
+                logger.warning("LCM API not responding after restart")
+                print(f"WARNING: LCM API did not respond within {LCM_ACTIVE_TIMEOUT} seconds, check 'systemctl status lcm'")
         print('NOTE: PRIOR TO RUNNING THE UPGRADE, PLEASE RUN UPGRADE PRECHECK AND ENSURE IT PASSES \n')
     else:
         logger.info("LCM restart skipped")